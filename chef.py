@@ -6,41 +6,69 @@ Videos from https://www.youtube.com/channel/UCNI0qOojpkhsUtaQ4_2NUhQ/playlists
 Assessment items from https://open.osmosis.org/topics
 """
 
+import atexit
 from collections import defaultdict
-import html
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache
 import os
 import pycountry
+import queue
 import re
 import requests
+import shutil
 import tempfile
+import threading
 import time
 from urllib.parse import urlparse, parse_qs
 
-from bs4 import BeautifulSoup
-import youtube_dl
+from lxml import etree
+import lxml.html
+from playwright.sync_api import Error as PlaywrightError, TimeoutError as PlaywrightTimeoutError
+from playwright.sync_api import sync_playwright
+import yt_dlp
 
 from le_utils.constants import content_kinds, file_formats, languages, exercises
 from ricecooker.chefs import SushiChef
 from ricecooker.classes import nodes, files, licenses, questions
 from ricecooker.utils.caching import CacheForeverHeuristic, FileCache, CacheControlAdapter, InvalidatingCacheControlAdapter
 from ricecooker.utils.browser import preview_in_browser
-from ricecooker.utils.html import download_file, WebDriver
+from ricecooker.utils.html import download_file
 from ricecooker.utils.zip import create_predictable_zip
 
 
+# Sessions are shared by the download threads, so keep enough pooled
+# connections around for all of them to reuse.
+POOL_MAXSIZE = 16
+
 sess = requests.Session()
 cache = FileCache('.webcache')
-forever_adapter = CacheControlAdapter(heuristic=CacheForeverHeuristic(), cache=cache)
+forever_adapter = CacheControlAdapter(heuristic=CacheForeverHeuristic(), cache=cache,
+        pool_maxsize=POOL_MAXSIZE)
 
 sess.mount('http://', forever_adapter)
 sess.mount('https://', forever_adapter)
 
-ydl = youtube_dl.YoutubeDL({
+# YouTube's subtitle URLs are signed and expire, so caching them would only
+# fill the cache with entries that are never read again.
+subtitle_sess = requests.Session()
+subtitle_adapter = requests.adapters.HTTPAdapter(pool_maxsize=POOL_MAXSIZE)
+subtitle_sess.mount('http://', subtitle_adapter)
+subtitle_sess.mount('https://', subtitle_adapter)
+
+YDL_OPTIONS = {
     'no_warnings': True,
     'writesubtitles': True,
     'allsubtitles': True,
     'ignoreerrors': True,  # Skip over deleted videos in a playlist
-})
+    'skip_download': True,
+    'writeinfojson': False,
+}
+
+# Only lists the entries of a channel or playlist (ids and titles), leaving
+# each video to be resolved on its own later.
+FLAT_YDL_OPTIONS = dict(YDL_OPTIONS, extract_flat='in_playlist')
+
+ydl = yt_dlp.YoutubeDL(FLAT_YDL_OPTIONS)
 
 LICENSE = licenses.CC_BY_SALicense(
     copyright_holder='Open Osmosis (open.osmosis.org)')
@@ -67,14 +95,16 @@ QUESTION_VIDEO_MAP = {
     "Ophthalmology": None,
     "Radiology": None,
     "Surgery": None,
-    None: "Pathophysiology",
-    None: "The science of teaching and learning",
-    None: "Physiology",
-    None: "Ear, nose, and throat",
-    None: "Immune disorders",
-    None: "Fluid and Electrolyte Imbalances",
-    None: "Maternal pathology",
 }
+# YouTube playlists that have no corresponding assessment topic, and so are
+# left out of the map above:
+#   - Pathophysiology
+#   - The science of teaching and learning
+#   - Physiology
+#   - Ear, nose, and throat
+#   - Immune disorders
+#   - Fluid and Electrolyte Imbalances
+#   - Maternal pathology
 
 
 class OpenOsmosisChef(SushiChef):
@@ -112,6 +142,8 @@ class OpenOsmosisChef(SushiChef):
         return channel
 
 
+VIDEO_WORKERS = 16
+
 def fetch_youtube_playlists(parent_node):
     """Fetch all of the YouTube playlists from the YouTube channel.
 
@@ -123,7 +155,17 @@ def fetch_youtube_playlists(parent_node):
 
     topics_map = {}
     info = ydl.extract_info(youtube_channel_url, download=False)
-    for i, playlist in enumerate(info['entries']):
+    playlist_urls = [PLAYLIST_URL % entry['id'] for entry in info['entries']]
+
+    # Extracting a playlist is slow and mostly spent inside yt-dlp, so
+    # extract each one in its own process and build the nodes back here.
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        playlists = list(executor.map(extract_playlist, playlist_urls))
+
+    playlist_topics = []
+    for i, playlist in enumerate(playlists):
+        if not playlist:
+            continue
         title = playlist['title']
         youtube_url = playlist['webpage_url']
         print("  Downloading playlist %s (%s)" % (title, youtube_url))
@@ -132,61 +174,233 @@ def fetch_youtube_playlists(parent_node):
                 language="en")
         topics_map[title] = playlist_topic
         parent_node.add_child(playlist_topic)
-        for j, video in enumerate(playlist['entries']):
+        videos = [video for video in playlist['entries'] if video]
+        playlist_topics.append((playlist_topic, videos))
+
+    # Resolve the videos of every playlist on a pool of threads, and build
+    # each node here as its info comes in. All of the network work overlaps,
+    # while the tree is only ever built from this thread.
+    # Subtitle tracks have to outlive this function, as ricecooker only
+    # processes the files once the whole tree is built.
+    subtitle_dir = tempfile.mkdtemp(prefix='subtitles-')
+    atexit.register(shutil.rmtree, subtitle_dir, ignore_errors=True)
+
+    video_nodes = [[None] * len(videos) for _, videos in playlist_topics]
+    with ThreadPoolExecutor(max_workers=VIDEO_WORKERS) as executor:
+        futures = {}
+        for i, (_, videos) in enumerate(playlist_topics):
+            for j, video in enumerate(videos):
+                future = executor.submit(fetch_video_info, video, subtitle_dir)
+                futures[future] = (i, j)
+
+        for future in as_completed(futures):
+            video = future.result()
             if video:
-                playlist_topic.add_child(fetch_video(video))
+                i, j = futures[future]
+                video_nodes[i][j] = create_video_node(video)
+
+    # Attach the videos in their playlist order.
+    for (playlist_topic, _), topic_video_nodes in zip(playlist_topics, video_nodes):
+        for video_node in topic_video_nodes:
+            if video_node:
+                playlist_topic.add_child(video_node)
 
     return topics_map
 
 
-def fetch_assessment_topics(parent_node, topics_map):
-    """Fetch all of the assessment topics listed in Open Osmosis."""
-    assessment_topics_url = "https://open.osmosis.org/topics"
-    print("--- Fetching assessments from %s ---" % assessment_topics_url)
-    print()
+PLAYLIST_URL = 'https://www.youtube.com/playlist?list=%s'
+
+def extract_playlist(playlist_url):
+    """Extract the info of a playlist and the ids and titles of its videos.
+
+    Called from worker processes, so this uses its own YoutubeDL instance.
+    """
+    playlist_ydl = yt_dlp.YoutubeDL(FLAT_YDL_OPTIONS)
+    return playlist_ydl.extract_info(playlist_url, download=False)
+
 
-    with WebDriver("https://open.osmosis.org/topics", delay=1000) as driver:
-        page_html = get_generated_html_from_driver(driver)
-        doc = BeautifulSoup(page_html, "html.parser")
+VIDEO_URL = 'https://www.youtube.com/watch?v=%s'
 
-        for i, topic in enumerate(doc.select('.container .topic')):
-            link = topic.select_one('a')
-            href = link['href']
-            topic_id = href.split('/')[-1]
-            url = make_fully_qualified_url(href)
-            text = link.text.strip()
-            img = link.select_one('img')['src']
+_thread_local = threading.local()
 
-            print('Fetching topic %s (%s)' % (text, url))
+def extract_video(youtube_id):
+    """Extract the metadata of a video, including its subtitle tracks.
 
-            # Get the topic node, either by trying to finding the corresponding
-            # topic node that was created in the earlier videos scraping step,
-            # or creating a new one.
-            topic_node = None
-            video_topic_name = QUESTION_VIDEO_MAP.get(text)
+    Returns None if the video could not be extracted (e.g. it was deleted).
+    Each thread gets its own YoutubeDL instance, as they aren't thread-safe.
+    """
+    if not hasattr(_thread_local, 'ydl'):
+        _thread_local.ydl = yt_dlp.YoutubeDL(YDL_OPTIONS)
+    # The extractor's result already has everything the chef uses, so skip
+    # yt-dlp's processing step (format selection and so on).
+    return _thread_local.ydl.extract_info(VIDEO_URL % youtube_id,
+            download=False, process=False)
 
-            if video_topic_name:
-                topic_node = topics_map.get(video_topic_name)
-                if topic_node:
-                    topic_node.title = "%s (%s)" % (text, video_topic_name)
-                    topic_node.set_thumbnail(img)
 
-            if not topic_node:
-                topic_node = nodes.TopicNode(source_id=topic_id,
-                        title=text, thumbnail=img)
-                parent_node.add_child(topic_node)
+NAVIGATION_TIMEOUT = 60000  # milliseconds
 
-            fetch_assessment_topic_items(driver, topic_node, url,
-                    topic_short_title=text, thumbnail=img)
+def open_page(browser):
+    """Open a page in a new, isolated context of `browser`."""
+    page = browser.new_context().new_page()
+    page.set_default_navigation_timeout(NAVIGATION_TIMEOUT)
+    return page
+
+
+def load_page(page, url, wait_until="domcontentloaded"):
+    """Navigate `page` to `url`, by default returning once its document is parsed.
+
+    Images and the like may still be loading, so callers then wait for the
+    elements they need.
+    """
+    page.goto(url, wait_until=wait_until)
+
+
+ASSESSMENT_WORKERS = 8
+
+def fetch_assessment_topics(parent_node, topics_map):
+    """Fetch all of the assessment topics listed in Open Osmosis."""
+    assessment_topics_url = "https://open.osmosis.org/topics"
+    print("--- Fetching assessments from %s ---" % assessment_topics_url)
+    print()
+
+    # Only start the browser if the server doesn't render the topic list.
+    page_html, _ = fetch_static_page(assessment_topics_url, TOPIC_XPATH)
+    if page_html is None:
+        page_html = fetch_topics_page(assessment_topics_url)
+    doc = lxml.html.document_fromstring(page_html)
+
+    # Topic nodes are created and attached here, in page order; the workers
+    # below only add exercises to their own topic node.
+    topic_queue = queue.Queue()
+    for i, topic in enumerate(TOPIC_XPATH(doc)):
+        link = _select_one(LINK_XPATH, topic)
+        href = link.get('href')
+        topic_id = href.split('/')[-1]
+        url = make_fully_qualified_url(href)
+        text = link.text_content().strip()
+        img = _select_one(IMG_XPATH, link).get('src')
+
+        print('Fetching topic %s (%s)' % (text, url))
+
+        # Get the topic node, either by trying to finding the corresponding
+        # topic node that was created in the earlier videos scraping step,
+        # or creating a new one.
+        topic_node = None
+        video_topic_name = QUESTION_VIDEO_MAP.get(text)
+
+        if video_topic_name:
+            topic_node = topics_map.get(video_topic_name)
+            if topic_node:
+                topic_node.title = "%s (%s)" % (text, video_topic_name)
+                topic_node.set_thumbnail(img)
+
+        if not topic_node:
+            topic_node = nodes.TopicNode(source_id=topic_id,
+                    title=text, thumbnail=img)
+            parent_node.add_child(topic_node)
+
+        topic_queue.put((topic_node, url, text, img))
+
+    # Each topic's items have to be walked one after another, but the topics
+    # themselves are independent, so walk several at a time.
+    num_workers = min(ASSESSMENT_WORKERS, topic_queue.qsize())
+    if not num_workers:
+        return
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(fetch_queued_assessment_topics, topic_queue)
+                for _ in range(num_workers)]
+        for future in as_completed(futures):
+            future.result()
+
+
+def fetch_topics_page(url):
+    """Render the topics page in the browser and return its HTML.
+
+    The browser is closed as soon as the page has been read, rather than
+    staying open while the topics are fetched.
+    """
+    with sync_playwright() as playwright:
+        browser = playwright.chromium.launch(headless=True)
+        try:
+            page = open_page(browser)
+            for i in range(MAX_ITEM_ATTEMPTS):
+                try:
+                    load_page(page, url)
+                    page.wait_for_selector('.container .topic', state='attached',
+                            timeout=RENDER_TIMEOUT)
+                    # Tiles may keep coming in after the first one, so also
+                    # wait for the page to stop fetching them. That may never
+                    # happen if the page keeps polling, so it's best-effort.
+                    try:
+                        page.wait_for_load_state('networkidle', timeout=RENDER_TIMEOUT)
+                    except PlaywrightTimeoutError:
+                        print("WARNING: The topics page kept loading, reading it anyway")
+                    return page.content()
+                except PlaywrightError as e:
+                    if i == MAX_ITEM_ATTEMPTS - 1:
+                        raise
+                    wait_time = min(2 ** i, MAX_RETRY_WAIT)
+                    print("Got an error, retrying after a wait of %s seconds. "
+                            "Error was: %s" % (wait_time, str(e)))
+                    time.sleep(wait_time)
+        finally:
+            browser.close()
+
+
+def fetch_queued_assessment_topics(topic_queue):
+    """Fetch the items of topics from `topic_queue` until it is empty.
+
+    Playwright's sync API can't share a browser between threads, so each
+    worker thread launches and closes its own. If a topic fails, the queue is
+    emptied so that the other workers stop after their current topic.
+    """
+    with sync_playwright() as playwright:
+        browser = playwright.chromium.launch(headless=True)
+        try:
+            page = open_page(browser)
+            while True:
+                try:
+                    topic_node, url, text, img = topic_queue.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    fetch_assessment_topic_items(page, topic_node, url,
+                            topic_short_title=text, thumbnail=img)
+                except Exception:
+                    _clear_queue(topic_queue)
+                    raise
+        finally:
+            browser.close()
+
+
+def _clear_queue(q):
+    while True:
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            return
 
 
 def _title_exercise(topic_title, first_item, last_item):
     return "%s Questions %s-%s" % (topic_title, first_item, last_item)
 
 
+def _add_exercise(topic_node, source_id, exercise_questions, last_item,
+        topic_short_title, thumbnail=None):
+    """Add an exercise holding the given questions, which end at `last_item`."""
+    first_item = last_item - len(exercise_questions) + 1
+    exercise_node = nodes.ExerciseNode(source_id=source_id,
+            title=_title_exercise(topic_short_title, first_item, last_item),
+            license=LICENSE, thumbnail=thumbnail,
+            exercise_data={'randomize': False})
+    for question in exercise_questions:
+        exercise_node.add_question(question)
+    topic_node.add_child(exercise_node)
+
+
 QUESTIONS_PER_EXERCISE = 5
 
-def fetch_assessment_topic_items(driver, topic_node, topic_url,
+def fetch_assessment_topic_items(page, topic_node, topic_url,
         topic_short_title, thumbnail=None):
     """Fetch the individual assessment items for a given topic.
 
@@ -194,77 +408,199 @@ def fetch_assessment_topic_items(driver, topic_node, topic_url,
     """
     next_item_url = topic_url
     item_count = 0
+    exercise_questions = []
 
     while next_item_url:
-        driver.get(next_item_url)
-        current_url = driver.current_url
-        item_id = current_url.split('/')[-1]
-
-        print('  Fetching question %s (%s)' % (item_count + 1, current_url))
-
-        # Create exercise node, grouping together every 5 questions.
-        if item_count % QUESTIONS_PER_EXERCISE == 0:
-            first_item_index_in_exercise = item_count
-            exercise_title = _title_exercise(topic_short_title, item_count + 1,
-                    item_count + QUESTIONS_PER_EXERCISE)
-            exercise_node = nodes.ExerciseNode(source_id=item_id,
-                    title=exercise_title, license=LICENSE, thumbnail=thumbnail,
-                    exercise_data={'randomize': False})
-            topic_node.add_child(exercise_node)
-
-        # Now try to convert the page HTML into an assessment item, retrying
-        # on error, and then skipping any missing images after a few failed
-        # retries.
-        for i in range(0, 4):
-            try:
-                page_html = get_generated_html_from_driver(driver)
-                question, next_item_url = fetch_assessment_item(page_html, item_id)
-                break
-            except Exception as e:
-                wait_time = (2 ** i)
-                print("Got an error, retrying after a wait of %s seconds. "
-                        "Error was: %s" % (wait_time, str(e)))
-                driver.get(current_url)
-                time.sleep(wait_time)
-                exception = e
-        else:
-            print("Going to try skipping any missing images")
-            page_html = get_generated_html_from_driver(driver)
-            question, next_item_url = fetch_assessment_item(page_html, item_id,
-                    skip_missing_images=True)
-
-        exercise_node.add_question(question)
+        print('  Fetching question %s (%s)' % (item_count + 1, next_item_url))
+
+        # Item pages that the server renders don't need the browser, and
+        # `sess` caches them so re-runs don't touch the network. That is,
+        # unless the browser is already loading the item (see
+        # `prefetch_next_item`).
+        question = None
+        if page.url != next_item_url:
+            page_html, current_url = fetch_static_page(next_item_url,
+                    is_item_rendered)
+            if page_html is not None:
+                try:
+                    question, next_item_url = fetch_assessment_item(page_html,
+                            current_url.split('/')[-1])
+                except Exception as e:
+                    print("Could not use the static page, falling back to the "
+                            "browser. Error was: %s" % str(e))
+
+        if question is None:
+            current_url, question, next_item_url = fetch_assessment_item_from_page(
+                    page, next_item_url)
+
+        # Exercises are named after their first item.
+        if not exercise_questions:
+            exercise_source_id = current_url.split('/')[-1]
+        exercise_questions.append(question)
         item_count += 1
 
-    # Re-title the exercise, given that this is the last exercise in the topic,
-    # which may not contain up to 5 items. (e.g. re-title it "Genetics 10-12")
-    exercise_node.title = _title_exercise(topic_short_title,
-            first_item_index_in_exercise + 1, item_count)
+        # Group together every 5 questions into an exercise.
+        if len(exercise_questions) == QUESTIONS_PER_EXERCISE:
+            _add_exercise(topic_node, exercise_source_id, exercise_questions,
+                    item_count, topic_short_title, thumbnail)
+            exercise_questions = []
+
+    # The last exercise in the topic may have fewer than 5 items, and is
+    # titled accordingly (e.g. "Genetics Questions 11-12").
+    if exercise_questions:
+        _add_exercise(topic_node, exercise_source_id, exercise_questions,
+                item_count, topic_short_title, thumbnail)
+
+
+STATIC_PAGE_TIMEOUT = 10  # seconds
+
+def fetch_static_page(url, is_rendered):
+    """Fetch a page without the browser, if the server renders it.
+
+    `is_rendered` is called with the parsed document, and says whether it has
+    everything that's needed from the page. Return a tuple (page html, final
+    url), or (None, None) if some of that is only rendered client-side.
+    """
+    try:
+        response = sess.get(url, timeout=STATIC_PAGE_TIMEOUT)
+        response.raise_for_status()
+    except requests.exceptions.RequestException:
+        return None, None
+
+    try:
+        doc = lxml.html.document_fromstring(response.text)
+    except etree.ParserError:
+        # e.g. an empty body
+        return None, None
+    if not is_rendered(doc):
+        return None, None
+    return response.text, response.url
+
+
+MAX_ITEM_ATTEMPTS = 5
+MAX_RETRY_WAIT = 4  # seconds
+
+def fetch_assessment_item_from_page(page, url):
+    """Fetch an assessment item by loading `url` in the browser.
+
+    Return a tuple (item url, question object, next item url). Topic URLs
+    redirect to their first item, so the item url may differ from `url`.
+    """
+    # Try to convert the page HTML into an assessment item, retrying on
+    # errors that waiting can fix. The last attempt skips any missing images.
+    skip_missing_images = False
+    for i in range(MAX_ITEM_ATTEMPTS):
+        if i == MAX_ITEM_ATTEMPTS - 1 and not skip_missing_images:
+            print("Going to try skipping any missing images")
+            skip_missing_images = True
+        rendered = False
+        try:
+            # The browser may already be on the item (see `prefetch_next_item`).
+            if i > 0 or page.url != url:
+                load_page(page, url)
+            wait_for_item(page)
+            rendered = True
+            current_url = page.url
+            page_html = page.content()
+            question, next_item_url = fetch_assessment_item(page_html,
+                    current_url.split('/')[-1], skip_missing_images)
+            prefetch_next_item(page, next_item_url)
+            return current_url, question, next_item_url
+        except Exception as e:
+            if i == MAX_ITEM_ATTEMPTS - 1:
+                raise
+            if rendered and not isinstance(e, (PlaywrightError, MissingImageError)):
+                # The whole item was on the page, so this comes from its
+                # structure, which waiting won't change.
+                if skip_missing_images:
+                    raise
+                print("Got an error that retrying won't fix, going to try "
+                        "skipping any missing images. Error was: %s" % str(e))
+                skip_missing_images = True
+                continue
+            # The page, or an image in it, may just need longer to load.
+            wait_time = min(2 ** i, MAX_RETRY_WAIT)
+            print("Got an error, retrying after a wait of %s seconds. "
+                    "Error was: %s" % (wait_time, str(e)))
+            time.sleep(wait_time)
+
+
+def prefetch_next_item(page, next_item_url):
+    """Send the browser on to the next item, without waiting for it to load.
+
+    The page is already on its way when the next item is fetched, which then
+    waits for it to render instead of fetching the static page or navigating.
+    """
+    if next_item_url:
+        try:
+            load_page(page, next_item_url, wait_until="commit")
+        except PlaywrightError:
+            pass  # the item is loaded again when it's fetched
+
+
+def _has_class(class_name):
+    """XPath predicate matching elements that have the given CSS class."""
+    return 'contains(concat(" ", normalize-space(@class), " "), " %s ")' % class_name
+
+
+# Compiled once here rather than per item, since every question page goes
+# through all of them.
+TOPIC_XPATH = etree.XPath('//*[%s]//*[%s]' % (
+    _has_class('container'), _has_class('topic')))
+LINK_XPATH = etree.XPath('.//a')
+STEM_XPATH = etree.XPath('//*[@id="Content"]//*[%s]' % _has_class('stem'))
+ANSWERS_XPATH = etree.XPath('//*[%s]//*[%s]//div' % (
+    _has_class('answers'), _has_class('ans')))
+CORRECT_XPATH = etree.XPath('//*[%s]//*[%s]' % (
+    _has_class('answers-explained'), _has_class('fwb')))
+CORRECT_TEXT_XPATH = etree.XPath('string(//*[%s]//*[%s])' % (
+    _has_class('answers-explained'), _has_class('fwb')))
+EXPLAIN_ANS_XPATH = etree.XPath('//*[%s]//*[%s]' % (
+    _has_class('answers-explained'), _has_class('explain-ans')))
+EXPLAIN_XPATH = etree.XPath('//*[%s]//*[%s]' % (
+    _has_class('answers-explained'), _has_class('explain')))
+NEXT_NAV_XPATH = etree.XPath('//*[%s]' % _has_class('ques-nav-right'))
+NEXT_LINK_XPATH = etree.XPath('//*[%s]//a' % _has_class('ques-nav-right'))
+IMAGE_XPATH = etree.XPath('.//*[%s]' % _has_class('models-media-Image'))
+IMG_XPATH = etree.XPath('.//img')
+TEXT_XPATH = etree.XPath('.//text()', smart_strings=False)
+
+
+def _select_one(xpath, node):
+    """Return the first element matching `xpath` under `node`, or None."""
+    results = xpath(node)
+    return results[0] if results else None
+
+
+class MissingImageError(Exception):
+    """An item's image hasn't been rendered, possibly because it's still loading."""
 
 
 def _process_text_into_markdown(container_node, skip_missing_images):
-    markdown_text = ''
-
-    for node in container_node.children:
-        image = node.select_one('.models-media-Image')
-        if image:
-            assert len(node.select('.models-media-Image')) == 1, 'multiple images found'
-            image_tag = image.select_one('img')
-            if not image_tag:
+    markdown_parts = []
+
+    for node in container_node.iterchildren():
+        images = IMAGE_XPATH(node)
+        if images:
+            assert len(images) == 1, 'multiple images found'
+            image = images[0]
+            image_tag = _select_one(IMG_XPATH, image)
+            if image_tag is None:
                 if skip_missing_images:
                     continue
                 else:
-                    raise Exception("Cannot find img tag where we expect one")
-            src = image_tag['src']
-            credit = image.text.strip()
-            markdown_text += '![%s](%s)\n\n%s\n\n' % (credit, src, credit)
+                    raise MissingImageError("Cannot find img tag where we expect one")
+            src = image_tag.get('src')
+            credit = image.text_content().strip()
+            markdown_parts.append('![%s](%s)\n\n%s\n\n' % (credit, src, credit))
         else:
-            text = node.get_text(separator="\n").strip()
-            if 'fwb' in node.get('class', []):
+            text = "\n".join(TEXT_XPATH(node)).strip()
+            classes = node.get('class')
+            if classes and 'fwb' in classes.split():
                 text = '**' + text + '**'
-            markdown_text += text + "\n\n"
+            markdown_parts.append(text + "\n\n")
 
-    return markdown_text
+    return ''.join(markdown_parts)
 
 
 def fetch_assessment_item(page_html, item_id, skip_missing_images=False):
@@ -272,18 +608,22 @@ def fetch_assessment_item(page_html, item_id, skip_missing_images=False):
 
     Return a tuple (question object, next item url).
     """
-    doc = BeautifulSoup(page_html, "html.parser")
+    doc = lxml.html.document_fromstring(page_html)
 
-    question_markdown = _process_text_into_markdown(doc.select_one('#Content .stem'),
+    question_markdown = _process_text_into_markdown(_select_one(STEM_XPATH, doc),
             skip_missing_images)
-    answers = [ans.text.strip() for ans in doc.select('.answers .ans div')]
-    correct = doc.select_one('.answers-explained .fwb').text.strip()
+    answers = [ans.text_content().strip() for ans in ANSWERS_XPATH(doc)]
+    if not answers:
+        raise Exception("Cannot find the answers")
+    correct = CORRECT_TEXT_XPATH(doc).strip()
+    if not correct:
+        raise Exception("Cannot find the correct answer")
 
     # TODO(davidhu): Get videos from hints, e.g. in https://open.osmosis.org/item/142641
     # TODO(davidhu): Fine-tune line spacing for hints
-    hint_1 = _process_text_into_markdown(doc.select_one('.answers-explained .explain-ans'),
+    hint_1 = _process_text_into_markdown(_select_one(EXPLAIN_ANS_XPATH, doc),
             skip_missing_images)
-    hint_2 = _process_text_into_markdown(doc.select_one('.answers-explained .explain'),
+    hint_2 = _process_text_into_markdown(_select_one(EXPLAIN_XPATH, doc),
             skip_missing_images)
     combined_hint = "%s\n\nMain Explanation\n---\n\n%s" % (hint_1, hint_2)
 
@@ -292,73 +632,193 @@ def fetch_assessment_item(page_html, item_id, skip_missing_images=False):
             correct_answer=correct)
 
     next_item_url = None
-    next_link = doc.select_one('.ques-nav-right a')
-    if next_link:
-        next_href = doc.select_one('.ques-nav-right a')['href']
+    next_link = _select_one(NEXT_LINK_XPATH, doc)
+    if next_link is not None:
+        next_href = next_link.get('href')
         if not next_href.endswith('null'):
             next_item_url = make_fully_qualified_url(next_href)
 
     return question, next_item_url
 
 
-def fetch_video(video):
-    youtube_id = video['id']
-    title = video['title']
-    description = video['description']
-    youtube_url = video['webpage_url']
-    subtitle_languages = video['subtitles'].keys()
+def fetch_video_info(video, subtitle_dir):
+    """Resolve a flat playlist entry and download its subtitle tracks.
+
+    Does all of the network work for a video, so that `create_video_node`
+    doesn't have to. Subtitles are saved into `subtitle_dir`. Returns None for
+    videos that could not be extracted.
+    """
+    video = extract_video(video['id'])
+    if not video:
+        return None
+
+    print("    Fetching video data: %s (%s)" % (video['title'], video['webpage_url']))
+
+    # Tracks that come with a direct VTT URL are downloaded here; the rest are
+    # left to YouTubeSubtitleFile, which re-runs ricecooker's YouTube
+    # download for each language.
+    subtitle_urls = {}
+    video['youtube_subtitle_languages'] = []
+    for language, tracks in video['subtitles'].items():
+        # TODO(david): Should catch exception thrown by
+        # files.YouTubeSubtitleFile rather than breaking abstraction.
+        if not getlang_by_youtube_code(language):
+            print("WARNING: Subtitle language %s not found in languages file" % language)
+            continue
+
+        vtt_urls = [track['url'] for track in tracks
+                if track.get('ext') == file_formats.VTT]
+        if vtt_urls:
+            subtitle_urls[language] = vtt_urls[0]
+        else:
+            video['youtube_subtitle_languages'].append(language)
+
+    # Fetch all of this video's subtitle tracks at once, on the pool shared by
+    # every video. Tracks that fail to download are left to YouTubeSubtitleFile.
+    paths = subtitle_executor.map(download_subtitle, subtitle_urls.values(),
+            [subtitle_dir] * len(subtitle_urls))
+    video['subtitle_paths'] = {}
+    for language, path in zip(subtitle_urls, paths):
+        if path:
+            video['subtitle_paths'][language] = path
+        else:
+            video['youtube_subtitle_languages'].append(language)
+
+    return video
 
-    print("    Fetching video data: %s (%s)" % (title, youtube_url))
+
+def create_video_node(video):
+    """Build the video node for a video resolved by `fetch_video_info`."""
+    youtube_id = video['id']
 
     video_node = nodes.VideoNode(
         source_id=youtube_id,
-        title=truncate_metadata(title),
+        title=truncate_metadata(video['title']),
         license=LICENSE,
-        description=truncate_description(description),
+        description=truncate_description(video['description']),
         derive_thumbnail=True,
         language="en",
         files=[files.YouTubeVideoFile(youtube_id=youtube_id)],
     )
 
-    # Add subtitles in whichever languages are available.
-    for language in subtitle_languages:
-        # TODO(david): Should catch exception thrown by
-        # files.YouTubeSubtitleFile rather than breaking abstraction.
-        if languages.getlang(language) or languages.getlang_by_alpha2(language):
+    # Add subtitles in whichever languages are available, keeping one track
+    # per language: e.g. YouTube's "iw" and "he" are both Hebrew.
+    subtitle_languages = {}
+    for language in list(video['subtitle_paths']) + video['youtube_subtitle_languages']:
+        code = getlang_by_youtube_code(language).code
+        if code in subtitle_languages:
+            print("WARNING: Skipping subtitle language %s, as %s is also %s" % (
+                language, subtitle_languages[code], code))
+            continue
+        subtitle_languages[code] = language
+
+        if language in video['subtitle_paths']:
+            video_node.add_file(files.SubtitleFile(
+                path=video['subtitle_paths'][language], language=code))
+        else:
             video_node.add_file(files.YouTubeSubtitleFile(
                 youtube_id=youtube_id, language=language))
-        else:
-            print("WARNING: Subtitle language %s not found in languages file" % language)
 
     return video_node
 
 
+@lru_cache(maxsize=None)
+def getlang_by_youtube_code(language):
+    """Look up the le_utils language for a YouTube subtitle language code.
+
+    Returns None if there is no matching language. The same couple dozen
+    codes come up on every video, so lookups are cached.
+    """
+    return languages.getlang(language) or languages.getlang_by_alpha2(language)
+
+
+SUBTITLE_WORKERS = 8
+SUBTITLE_TIMEOUT = 30
+
+# A single pool for all subtitle downloads, so that the number of requests in
+# flight doesn't grow with the number of video threads.
+subtitle_executor = ThreadPoolExecutor(max_workers=SUBTITLE_WORKERS)
+
+def download_subtitle(url, directory):
+    """Download a subtitle track to a VTT file in `directory`.
+
+    Return the path of the file, or None if the track could not be downloaded.
+    """
+    try:
+        response = subtitle_sess.get(url, timeout=SUBTITLE_TIMEOUT)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print("WARNING: Could not download subtitle track %s (%s)" % (url, e))
+        return None
+    with tempfile.NamedTemporaryFile(suffix='.' + file_formats.VTT,
+            dir=directory, delete=False) as f:
+        f.write(response.content)
+    return f.name
+
+
 DESCRIPTION_RE = re.compile('Subscribe - .*$')
+# The line boundaries that str.splitlines() splits on.
+LINE_BREAK_RE = re.compile('\r\n|[\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029]')
 
 def truncate_description(description):
-    first_line = description.splitlines()[0]
+    if not description:
+        return ''
+    first_line = LINE_BREAK_RE.split(description, maxsplit=1)[0]
     return DESCRIPTION_RE.sub('', first_line)
 
 
+MAX_METADATA_CHARS = 190
+
 def truncate_metadata(data_string):
-    MAX_CHARS = 190
-    if len(data_string) > MAX_CHARS:
-        data_string = data_string[:190] + " ..."
-    return data_string
+    if len(data_string) <= MAX_METADATA_CHARS:
+        return data_string
+    return data_string[:MAX_METADATA_CHARS] + " ..."
 
 
+@lru_cache(maxsize=4096)
 def make_fully_qualified_url(url):
-    if url.startswith("//"):
-        return "http:" + url
-    if url.startswith("/"):
+    # Site-relative links (e.g. "/item/123") are by far the most common.
+    if url[:1] == "/":
+        if url[1:2] == "/":
+            return "http:" + url
         return "https://open.osmosis.org" + url
-    if not url.startswith("http"):
-        return "https://open.osmosis.org/" + url
-    return url
-
-
-def get_generated_html_from_driver(driver, tagname="html"):
-    return driver.execute_script("return document.getElementsByTagName('{tagname}')[0].innerHTML".format(tagname=tagname))
+    if url[:4] == "http":
+        return url
+    return "https://open.osmosis.org/" + url
+
+
+RENDER_TIMEOUT = 10000  # milliseconds
+
+# Everything `fetch_assessment_item` reads from an item page. The stem shows up
+# first, so waiting for it alone can catch the page half rendered.
+ITEM_SELECTORS = [
+    '#Content .stem',
+    '.answers .ans div',
+    '.answers-explained .fwb',
+    '.answers-explained .explain-ans',
+    '.answers-explained .explain',
+    '.ques-nav-right',
+]
+
+# The same elements, for item pages that are fetched without the browser.
+ITEM_XPATHS = [
+    STEM_XPATH,
+    ANSWERS_XPATH,
+    CORRECT_XPATH,
+    EXPLAIN_ANS_XPATH,
+    EXPLAIN_XPATH,
+    NEXT_NAV_XPATH,
+]
+
+def wait_for_item(page):
+    """Wait until the whole assessment item has been rendered on the current page."""
+    for selector in ITEM_SELECTORS:
+        page.wait_for_selector(selector, state='attached', timeout=RENDER_TIMEOUT)
+
+
+def is_item_rendered(doc):
+    """Whether the whole assessment item is in the parsed page `doc`."""
+    return all(xpath(doc) for xpath in ITEM_XPATHS)
 
 
 if __name__ == '__main__':